@@ -0,0 +1,22 @@
+"""
+Numba kernels for WebSocketSavePromptID
+Imported lazily from nodes.py, since importing numba adds noticeably to startup time
+"""
+
+import numba
+import numpy as np
+
+
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def quantize_f32_to_u8(src, dst):
+    """
+    Scale, clamp and cast a flat float32 array to uint8 in one pass
+    """
+    for i in numba.prange(src.shape[0]):
+        v = src[i] * 255.0
+        if v < 0:
+            dst[i] = 0
+        elif v > 255:
+            dst[i] = 255
+        else:
+            dst[i] = np.uint8(v)
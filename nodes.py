@@ -9,39 +9,211 @@ import numpy as np
 import json
 import time
 import os
-import inspect
+import io
+import struct
+import functools
+import importlib
+from concurrent.futures import ThreadPoolExecutor
 import threading
 
 try:
+    import torch
     import comfy.utils
-    import folder_paths
     COMFY_AVAILABLE = True
 except ImportError:
     COMFY_AVAILABLE = False
     print("[WebSocketSavePromptID] Warning: ComfyUI modules not available")
 
 
+# Per-thread execution context populated by the PromptExecutor hook
+_execution_context = threading.local()
+
+
+def _install_prompt_id_hook():
+    """
+    Wrap PromptExecutor.execute so the running prompt_id is stored in the
+    executing thread's context, where nodes can read it without searching
+    """
+    try:
+        import execution
+    except ImportError:
+        return
+
+    executor = getattr(execution, "PromptExecutor", None)
+    original = getattr(executor, "execute", None)
+    if original is None or getattr(original, "_ws_prompt_id_hook", False):
+        return
+
+    @functools.wraps(original)
+    def execute(self, prompt, prompt_id, *args, **kwargs):
+        _execution_context.prompt_id = prompt_id
+        return original(self, prompt, prompt_id, *args, **kwargs)
+
+    execute._ws_prompt_id_hook = True
+    executor.execute = execute
+
+
+if COMFY_AVAILABLE:
+    _install_prompt_id_hook()
+
+try:
+    import orjson
+    _dumps = orjson.dumps
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+# Optional modules imported on first use, to keep them out of ComfyUI startup
+_optional_modules = {}
+
+
+def _optional_import(name):
+    """
+    Import an optional module the first time it is needed; None if it is not
+    installed or fails to load (e.g. a torchvision built for another torch)
+    """
+    if name not in _optional_modules:
+        try:
+            _optional_modules[name] = importlib.import_module(name, __package__)
+        except ImportError:
+            _optional_modules[name] = None
+        except Exception as e:
+            print(f"[WebSocketSavePromptID] Warning: could not load {name}, skipping it: {e}")
+            _optional_modules[name] = None
+    return _optional_modules[name]
+
+
+def _quantize_kernel():
+    """
+    The Numba quantization kernel, or None if numba is not installed
+    """
+    kernels = _optional_import("._quantize") if __package__ else None
+    return kernels.quantize_f32_to_u8 if kernels else None
+
+
+def _f32_to_u8(x):
+    """
+    Scale a float image array in [0, 1] to uint8, reusing one scratch buffer
+    for the multiply and clip instead of allocating a new array per step.
+    Arrays that are already uint8 are returned without copying
+    """
+    if x.dtype == np.uint8:
+        return np.ascontiguousarray(x)
+
+    kernel = _quantize_kernel() if x.dtype == np.float32 else None
+    if kernel is not None:
+        src = np.ascontiguousarray(x).reshape(-1)
+        dst = np.empty(src.shape, dtype=np.uint8)
+        kernel(src, dst)
+        return dst.reshape(x.shape)
+
+    tmp = np.multiply(x, 255.0, dtype=np.float32)
+    np.clip(tmp, 0, 255, out=tmp)
+    u8 = np.empty(tmp.shape, dtype=np.uint8)
+    np.copyto(u8, tmp, casting="unsafe")
+    return u8
+
+
+def _images_to_u8(images):
+    """
+    Quantize an IMAGE batch to uint8 on its own device before copying it to
+    the host, so only a quarter of the float32 bytes cross the bus
+    """
+    if isinstance(images, torch.Tensor):
+        if images.dtype == torch.uint8:
+            return images.detach().contiguous().cpu().numpy()
+        if images.device.type == "cpu" and images.dtype == torch.float32 and _quantize_kernel():
+            # On CPU the fused Numba kernel beats three separate torch passes
+            return _f32_to_u8(images.detach().contiguous().numpy())
+        u8 = images.detach().mul(255.0).clamp_(0, 255).to(torch.uint8)
+        return u8.contiguous().cpu().numpy()
+    return _f32_to_u8(np.asarray(images))
+
+
+# Binary WebSocket event type used for batched image frames
+WS_BATCH_EVENT = 0x5753
+
+# Leading byte of a batched frame naming how its metadata is encoded
+METADATA_JSON = 0
+METADATA_MSGPACK = 1
+
+
+# Formats the ComfyUI preview hook can encode itself
+PREVIEW_FORMATS = ("PNG", "JPEG")
+
+
+def _encode_image(img_array, image_format="PNG", quality=90, tv_io=None):
+    """
+    Encode a uint8 HWC image array to PNG, JPEG or WEBP bytes, or to RAW:
+    height|width|channels (uint32, big-endian) followed by the unencoded pixels.
+    PNG and JPEG use torchvision.io when tv_io is given, PIL otherwise
+    """
+    if image_format == "RAW":
+        height, width, channels = img_array.shape
+        return struct.pack("!III", height, width, channels) + img_array.tobytes()
+
+    if tv_io is not None and image_format in ("PNG", "JPEG") and img_array.shape[-1] in (1, 3):
+        # torchvision encodes straight from the tensor with libpng/libjpeg, no PIL image
+        chw = torch.from_numpy(img_array).permute(2, 0, 1).contiguous()
+        if image_format == "PNG":
+            return tv_io.encode_png(chw).numpy().tobytes()
+        return tv_io.encode_jpeg(chw, quality=quality).numpy().tobytes()
+
+    buffer = io.BytesIO()
+    if image_format == "PNG":
+        Image.fromarray(img_array).save(buffer, format="PNG")
+    else:
+        Image.fromarray(img_array).save(buffer, format=image_format, quality=quality)
+    return buffer.getvalue()
+
+
+def _send_batch(metadata_kind, metadata_bytes, images_bytes):
+    """
+    Send several encoded images with one shared metadata blob in a single binary
+    WebSocket frame. Layout: metadata kind (uint8), len|metadata, count, then
+    len|image per image (uint32, big-endian)
+    """
+    from server import PromptServer
+
+    parts = [struct.pack("!BI", metadata_kind, len(metadata_bytes)), metadata_bytes,
+             struct.pack("!I", len(images_bytes))]
+    for image_bytes in images_bytes:
+        parts.append(struct.pack("!I", len(image_bytes)))
+        parts.append(image_bytes)
+
+    server = PromptServer.instance
+    server.send_sync(WS_BATCH_EVENT, b"".join(parts), server.client_id)
+
+
 class WebSocketSavePromptID:
     """
     Save images via WebSocket with the real prompt_id from the ComfyUI request.
     The prompt_id is captured from the execution context and sent with each image.
     """
     
+    # Built once; ComfyUI queries INPUT_TYPES on every UI refresh and validation
+    _INPUT_TYPES_CACHE = {
+        "required": {
+            "images": ("IMAGE", ),
+        },
+        "optional": {
+            "filename_prefix": ("STRING", {"default": "ComfyUI", "multiline": False}),
+            "image_format": (["PNG", "JPEG", "WEBP", "RAW"], {"default": "PNG"}),
+            "batch_size": ("INT", {"default": 0, "min": 0, "max": 4096,
+                                   "tooltip": "0 sends one preview per image; N > 0 packs up to N images per binary frame"}),
+            "metadata_format": (["json", "msgpack"], {"default": "json",
+                                                      "tooltip": "Metadata encoding for batched frames (batch_size > 0)"}),
+        },
+        "hidden": {
+            "prompt": "PROMPT",
+            "extra_pnginfo": "EXTRA_PNGINFO", 
+            "unique_id": "UNIQUE_ID"
+        }
+    }
+
     @classmethod
     def INPUT_TYPES(cls):
-        return {
-            "required": {
-                "images": ("IMAGE", ),
-            },
-            "optional": {
-                "filename_prefix": ("STRING", {"default": "ComfyUI", "multiline": False}),
-            },
-            "hidden": {
-                "prompt": "PROMPT",
-                "extra_pnginfo": "EXTRA_PNGINFO", 
-                "unique_id": "UNIQUE_ID"
-            }
-        }
+        return cls._INPUT_TYPES_CACHE
     
     RETURN_TYPES = ()
     RETURN_NAMES = ()
@@ -49,127 +221,8 @@ class WebSocketSavePromptID:
     OUTPUT_NODE = True
     CATEGORY = "image/output"
     
-    def get_real_prompt_id(self):
-        """
-        Attempts to capture the real prompt_id from various sources in ComfyUI
-        """
-        prompt_id = None
-        
-        # Method 1: Try to get from execution module
-        if not prompt_id:
-            try:
-                import execution
-                # Check if there's a currently executing prompt
-                if hasattr(execution, 'PromptExecutor'):
-                    for attr in ['currently_executing', 'current_prompt', 'executing_prompt']:
-                        if hasattr(execution.PromptExecutor, attr):
-                            current = getattr(execution.PromptExecutor, attr)
-                            if current:
-                                if isinstance(current, (list, tuple)) and len(current) > 0:
-                                    prompt_id = str(current[0])
-                                elif isinstance(current, str):
-                                    prompt_id = current
-                                elif isinstance(current, dict) and 'prompt_id' in current:
-                                    prompt_id = current['prompt_id']
-                                if prompt_id:
-                                    print(f"[WebSocketSavePromptID] Found prompt_id from execution.{attr}: {prompt_id}")
-                                    break
-            except Exception as e:
-                pass
-        
-        # Method 2: Try to get from server module
-        if not prompt_id:
-            try:
-                from server import PromptServer
-                if hasattr(PromptServer, 'instance') and PromptServer.instance:
-                    server = PromptServer.instance
-                    # Check various possible attributes
-                    for attr in ['last_prompt_id', 'current_prompt_id', 'executing_prompt_id']:
-                        if hasattr(server, attr):
-                            pid = getattr(server, attr)
-                            if pid:
-                                prompt_id = str(pid)
-                                print(f"[WebSocketSavePromptID] Found prompt_id from server.{attr}: {prompt_id}")
-                                break
-            except Exception as e:
-                pass
-        
-        # Method 3: Inspect the call stack for prompt_id
-        if not prompt_id:
-            try:
-                frame = inspect.currentframe()
-                for _ in range(20):  # Check up to 20 frames up the stack
-                    if frame is None:
-                        break
-                    
-                    frame_locals = frame.f_locals
-                    frame_globals = frame.f_globals
-                    
-                    # Check locals
-                    if 'prompt_id' in frame_locals:
-                        pid = frame_locals['prompt_id']
-                        if pid and isinstance(pid, str):
-                            prompt_id = pid
-                            print(f"[WebSocketSavePromptID] Found prompt_id in stack locals: {prompt_id}")
-                            break
-                    
-                    # Check for objects containing prompt_id
-                    for var_name, var_value in frame_locals.items():
-                        if prompt_id:
-                            break
-                        
-                        # Check if object has prompt_id attribute
-                        if hasattr(var_value, 'prompt_id'):
-                            pid = getattr(var_value, 'prompt_id')
-                            if pid:
-                                prompt_id = str(pid)
-                                print(f"[WebSocketSavePromptID] Found prompt_id in {var_name}.prompt_id: {prompt_id}")
-                                break
-                        
-                        # Check if it's a dict with prompt_id
-                        if isinstance(var_value, dict):
-                            if 'prompt_id' in var_value:
-                                pid = var_value['prompt_id']
-                                if pid:
-                                    prompt_id = str(pid)
-                                    print(f"[WebSocketSavePromptID] Found prompt_id in dict {var_name}: {prompt_id}")
-                                    break
-                            # Also check for 'id' key
-                            elif 'id' in var_value and var_name in ['prompt', 'workflow', 'job']:
-                                pid = var_value['id']
-                                if pid and isinstance(pid, str) and len(pid) > 20:
-                                    prompt_id = str(pid)
-                                    print(f"[WebSocketSavePromptID] Found id in {var_name}: {prompt_id}")
-                                    break
-                    
-                    frame = frame.f_back
-                    
-            except Exception as e:
-                pass
-        
-        # Method 4: Check thread local storage
-        if not prompt_id:
-            try:
-                current_thread = threading.current_thread()
-                if hasattr(current_thread, 'prompt_id'):
-                    prompt_id = str(current_thread.prompt_id)
-                    print(f"[WebSocketSavePromptID] Found prompt_id in thread: {prompt_id}")
-            except Exception as e:
-                pass
-        
-        # Method 5: Try to get from global context
-        if not prompt_id:
-            try:
-                import __main__
-                if hasattr(__main__, 'prompt_id'):
-                    prompt_id = str(__main__.prompt_id)
-                    print(f"[WebSocketSavePromptID] Found prompt_id in __main__: {prompt_id}")
-            except Exception as e:
-                pass
-        
-        return prompt_id
-    
-    def save_via_websocket(self, images, filename_prefix="ComfyUI", 
+    def save_via_websocket(self, images, filename_prefix="ComfyUI", image_format="PNG", batch_size=0,
+                          metadata_format="json",
                           prompt=None, extra_pnginfo=None, unique_id=None):
         """
         Save images via WebSocket with metadata including the real prompt_id
@@ -179,8 +232,10 @@ class WebSocketSavePromptID:
             print("[WebSocketSavePromptID] Error: ComfyUI not available")
             return {}
         
-        # Get the real prompt_id from the execution context
-        prompt_id = self.get_real_prompt_id()
+        # Get the real prompt_id from the request, or from the executor hook
+        prompt_id = ((extra_pnginfo or {}).get("prompt_id")
+                     or (prompt or {}).get("prompt_id")
+                     or getattr(_execution_context, "prompt_id", None))
         
         # If no prompt_id found, generate a fallback
         if not prompt_id:
@@ -192,35 +247,72 @@ class WebSocketSavePromptID:
         
         # Process and send images
         try:
-            pbar = comfy.utils.ProgressBar(images.shape[0])
-            
-            print(f"[WebSocketSavePromptID] Processing {images.shape[0]} image(s)")
-            
-            for idx, image in enumerate(images):
-                # Convert tensor to numpy array and then to PIL Image
-                img_numpy = image.cpu().numpy()
-                img_array = np.clip(img_numpy * 255.0, 0, 255).astype(np.uint8)
-                pil_image = Image.fromarray(img_array)
-                
-                # Prepare metadata with the real prompt_id
-                metadata = {
-                    "prompt_id": prompt_id,  # The real prompt_id from the request
-                    "node_id": str(unique_id) if unique_id else "unknown",
-                    "image_index": idx,
-                    "total_images": images.shape[0],
-                    "filename_prefix": filename_prefix,
-                    "timestamp": time.time(),
-                    "timestamp_str": time.strftime("%Y%m%d_%H%M%S")
-                }
-                
-                # Convert metadata to JSON string
-                metadata_json = json.dumps(metadata, ensure_ascii=False)
-                
-                # Send via WebSocket: (format, image, metadata)
-                pbar.update_absolute(idx, images.shape[0], ("PNG", pil_image, metadata_json))
-                
-                print(f"[WebSocketSavePromptID] Sent image {idx+1}/{images.shape[0]} with prompt_id: {prompt_id}")
+            total_images = int(images.shape[0])
+            pbar = comfy.utils.ProgressBar(total_images)
             
+            print(f"[WebSocketSavePromptID] Processing {total_images} image(s)")
+
+            # Quantize on device and transfer the whole batch in a single copy
+            batch_u8 = _images_to_u8(images)
+
+            if batch_size <= 0 and image_format not in PREVIEW_FORMATS:
+                print(f"[WebSocketSavePromptID] Warning: {image_format} previews need batch_size > 0, sending PNG")
+                image_format = "PNG"
+
+            # Fields shared by every image
+            metadata = {
+                "prompt_id": prompt_id,  # The real prompt_id from the request
+                "node_id": str(unique_id) if unique_id else "unknown",
+                "total_images": total_images,
+                "filename_prefix": filename_prefix,
+                "image_format": image_format,
+                "timestamp": time.time(),
+                "timestamp_str": time.strftime("%Y%m%d_%H%M%S")
+            }
+
+            if batch_size > 0:
+                # Resolve torchvision once here rather than racing the import in every worker
+                tv_io = _optional_import("torchvision.io") if image_format in ("PNG", "JPEG") else None
+
+                # Encode all images in parallel; PIL releases the GIL while compressing
+                with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+                    encode = functools.partial(_encode_image, image_format=image_format, tv_io=tv_io)
+                    encoded = list(pool.map(encode, batch_u8))
+
+                msgpack = _optional_import("msgpack") if metadata_format == "msgpack" else None
+                if msgpack is not None:
+                    metadata_kind = METADATA_MSGPACK
+                    pack_metadata = functools.partial(msgpack.packb, use_bin_type=True)
+                else:
+                    if metadata_format == "msgpack":
+                        print("[WebSocketSavePromptID] Warning: msgpack not installed, sending JSON metadata")
+                    metadata_kind = METADATA_JSON
+                    pack_metadata = _dumps
+
+                # One metadata blob per frame; images are matched to "indices" by position
+                for start in range(0, total_images, batch_size):
+                    stop = min(start + batch_size, total_images)
+                    metadata["indices"] = list(range(start, stop))
+                    _send_batch(metadata_kind, pack_metadata(metadata), encoded[start:stop])
+                    pbar.update_absolute(stop, total_images)
+
+                    print(f"[WebSocketSavePromptID] Sent images {start+1}-{stop}/{total_images} with prompt_id: {prompt_id}")
+            else:
+                # Serialize the shared fields once, without the closing brace
+                metadata_prefix = _dumps(metadata).decode("utf-8")[:-1]
+
+                for idx in range(total_images):
+                    # Convert numpy array to PIL Image
+                    pil_image = Image.fromarray(batch_u8[idx])
+
+                    # Append the image index to the cached JSON prefix
+                    metadata_json = f'{metadata_prefix},"image_index":{idx}}}'
+
+                    # Send via WebSocket: (format, image, metadata)
+                    pbar.update_absolute(idx, total_images, (image_format, pil_image, metadata_json))
+
+                    print(f"[WebSocketSavePromptID] Sent image {idx+1}/{total_images} with prompt_id: {prompt_id}")
+
             print(f"[WebSocketSavePromptID] ✅ Successfully sent all images with prompt_id: {prompt_id}")
             
         except Exception as e: